@@ -1,11 +1,19 @@
 # Import core libraries
 
+import sqlite3
 import pickle
 import typing
+import fcntl
+import shutil
+import contextlib
+import time
 import os
+import re
+import math
 import hashlib
 import toml
 
+from collections import Counter
 from enum import Enum
 
 config = toml.load("./config.toml")
@@ -21,35 +29,189 @@ class Feedback(Enum):
 
 
 class PostType(typing.TypedDict):
-    feedbacks: dict[str, Feedback]
     media: str | None
     shash: str
     rating: int
+    text: str
 
 
-class DatabaseType(typing.TypedDict):
-    posts: dict[int, PostType]
-    timings: dict[str, int]
-    autodelete: list[int]
+class PurgeType(typing.TypedDict):
+    id: int
+    chat: int
+    message: int
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    shash TEXT NOT NULL,
+    media TEXT,
+    rating INTEGER NOT NULL DEFAULT 0,
+    text TEXT NOT NULL DEFAULT ''
+);
+
+CREATE TABLE IF NOT EXISTS feedbacks (
+    post INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    uhash TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (post, uhash)
+);
+
+CREATE TABLE IF NOT EXISTS terms (
+    token TEXT NOT NULL,
+    post INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (token, post)
+);
+
+CREATE INDEX IF NOT EXISTS terms_post ON terms (post);
+
+CREATE TABLE IF NOT EXISTS timings (
+    uhash TEXT PRIMARY KEY,
+    until REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS autodelete (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    post INTEGER NOT NULL UNIQUE REFERENCES posts (id) ON DELETE CASCADE,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS replies (
+    uhash TEXT PRIMARY KEY,
+    post INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    expires REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS replies_post ON replies (post);
+CREATE INDEX IF NOT EXISTS replies_expires ON replies (expires);
+
+CREATE TABLE IF NOT EXISTS purges (
+    id INTEGER PRIMARY KEY,
+    chat INTEGER NOT NULL,
+    message INTEGER NOT NULL,
+    due REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS claims (
+    key TEXT PRIMARY KEY,
+    at REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS claims_at ON claims (at);
+
+CREATE TABLE IF NOT EXISTS edits (
+    post INTEGER PRIMARY KEY REFERENCES posts (id) ON DELETE CASCADE,
+    version INTEGER NOT NULL DEFAULT 1
+);
+"""
 
 
 # Database Core Functions
 
-def save(db: DatabaseType, name: str = config['database']['file']) -> None:
-    with open(file=name, mode="wb") as f:
-        pickle.dump(obj=db, file=f)
+def connect(name: str = config['database']['file']) -> sqlite3.Connection:
+    ## Opens the database shared by every worker, an old pickle database is imported on first use
+
+    with open(file=name + ".lock", mode="a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        legacy = False
+
+        if os.path.exists(name):
+            with open(file=name, mode="rb") as f:
+                legacy = f.read(1) == b"\x80"
+
+        if legacy:
+            ## The import goes to a separate file that only replaces the pickle once it is complete,
+            ## so a failed or interrupted import leaves the pickle in place for the next start
+
+            temp = name + ".migrating"
 
+            if os.path.exists(temp):
+                os.remove(temp)
+
+            db = open_database(name=temp)
+
+            try:
+                migrate(db=db, name=name)
+            finally:
+                db.close()
+
+            shutil.copyfile(src=name, dst=name + ".pickle")
+            os.replace(src=temp, dst=name)
+
+        return open_database(name=name)
+
+
+def open_database(name: str) -> sqlite3.Connection:
+    ## The bot hands the connection to its database thread, so it must not be tied to the opening thread
+
+    db = sqlite3.connect(database=name, timeout=30, isolation_level=None, check_same_thread=False)
+    _ = db.execute("PRAGMA journal_mode = WAL")
+    _ = db.execute("PRAGMA foreign_keys = ON")
+    _ = db.executescript(SCHEMA)
+    return db
+
+
+@contextlib.contextmanager
+def transaction(db: sqlite3.Connection) -> typing.Iterator[sqlite3.Connection]:
+    ## Groups statements into one atomic write, nested transactions join the outer one
+
+    if db.in_transaction:
+        yield db
+        return
+
+    _ = db.execute("BEGIN IMMEDIATE")
 
-def load(name: str = config['database']['file']) -> DatabaseType:
     try:
-        with open(file=name, mode="rb") as f:
-            db: DatabaseType = pickle.load(file=f)
-            return db
+        yield db
+    except BaseException:
+        _ = db.execute("ROLLBACK")
+        raise
+
+    _ = db.execute("COMMIT")
+
+
+def migrate(db: sqlite3.Connection, name: str) -> None:
+    with open(file=name, mode="rb") as f:
+        legacy = pickle.load(file=f)
+
+    with transaction(db=db):
+        for id, post in legacy["posts"].items():
+            add_post(db=db, shash=post["shash"], id=id, media=post["media"], text=post.get("text", ""))
+
+            _ = db.execute("UPDATE posts SET rating = ? WHERE id = ?", (post["rating"], id))
+            _ = db.executemany(
+                "INSERT INTO feedbacks (post, uhash, value) VALUES (?, ?, ?)",
+                [(id, uhash, int(feedback)) for uhash, feedback in post["feedbacks"].items()],
+            )
 
-    except FileNotFoundError:
-        db: DatabaseType = {"posts": {}, "timings": {}, "autodelete": []}
-        save(db=db)
-        return db
+        _ = db.executemany(
+            "INSERT INTO timings (uhash, until) VALUES (?, ?)",
+            legacy["timings"].items(),
+        )
+
+        for id in legacy["autodelete"]:
+            if id in legacy["posts"]:
+                queue_autodelete(db=db, id=id)
+
+        for uhash, reply in legacy.get("replies", {}).items():
+            _ = set_reply(db=db, uhash=uhash, id=reply["post"], expires=reply["expires"])
+
+
+def acquire_leader(name: str = config['database']['file']) -> typing.IO | None:
+    ## Tries to become the worker that runs background jobs, the lock is released when the process exits
+
+    lock = open(file=name + ".leader", mode="a")
+
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+
+    return lock
 
 
 # Sugarcoated Functions
@@ -57,24 +219,281 @@ def load(name: str = config['database']['file']) -> DatabaseType:
 def hash(num: int) -> str:
     return hashlib.md5(string=str(num + config['database']['seed']).encode()).hexdigest()
 
-def add_post(db: DatabaseType, shash: str, id: int, media: str = None) -> None:
-    if id in db["posts"]:
-        return
+def tokenize(text: str) -> list[str]:
+    return re.findall(pattern=r"\w+", string=text.lower())
 
-    db["posts"][id] = {"feedbacks": {}, "media": media, "shash": shash, "rating": 0}
 
+def add_post(db: sqlite3.Connection, shash: str, id: int, media: str = None, text: str = "") -> None:
+    with transaction(db=db):
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO posts (id, shash, media, text) VALUES (?, ?, ?, ?)",
+            (id, shash, media, text),
+        )
 
-def remove_post(db: DatabaseType, id: int) -> None:
-    if id not in db["posts"]:
-        return
+        if cursor.rowcount == 0:
+            return
+
+        _ = db.executemany(
+            "INSERT INTO terms (token, post, count) VALUES (?, ?, ?)",
+            [(token, id, count) for token, count in Counter(tokenize(text=text)).items()],
+        )
+
+
+def get_post(db: sqlite3.Connection, id: int) -> PostType | None:
+    row = db.execute("SELECT media, shash, rating, text FROM posts WHERE id = ?", (id,)).fetchone()
+
+    if row is None:
+        return None
+
+    return {"media": row[0], "shash": row[1], "rating": row[2], "text": row[3]}
+
+
+def remove_post(db: sqlite3.Connection, id: int) -> None:
+    ## Feedbacks, index terms, queue entries and reply sessions of the post are removed with it
 
-    if id in db["autodelete"]:
-        db["autodelete"].remove(id)
+    with transaction(db=db):
+        row = db.execute("SELECT media FROM posts WHERE id = ?", (id,)).fetchone()
 
-    if db["posts"][id]["media"] is not None:
+        if row is None:
+            return
+
+        _ = db.execute("DELETE FROM posts WHERE id = ?", (id,))
+
+    if row[0] is not None:
         try:
-            os.remove(db["posts"][id]["media"])
+            os.remove(row[0])
         except FileNotFoundError:
             pass
 
-    del db["posts"][id]
+
+def vote(db: sqlite3.Connection, id: int, uhash: str, feedback: Feedback) -> tuple[bool, int] | None:
+    ## Toggles the feedback of a user on a post
+    ## Returns whether the feedback was added and the new rating, or None if the post does not exist
+
+    with transaction(db=db):
+        row = db.execute(
+            "SELECT value FROM feedbacks WHERE post = ? AND uhash = ?", (id, uhash)
+        ).fetchone()
+        previous = row[0] if row is not None else 0
+
+        if previous == int(feedback):
+            _ = db.execute("DELETE FROM feedbacks WHERE post = ? AND uhash = ?", (id, uhash))
+            added = False
+        else:
+            _ = db.execute(
+                "INSERT INTO feedbacks (post, uhash, value) SELECT id, ?, ? FROM posts WHERE id = ? "
+                "ON CONFLICT (post, uhash) DO UPDATE SET value = excluded.value",
+                (uhash, int(feedback), id),
+            )
+            added = True
+
+        cursor = db.execute(
+            "UPDATE posts SET rating = rating + ? WHERE id = ?",
+            (int(feedback) - previous if added else -previous, id),
+        )
+
+        if cursor.rowcount == 0:
+            return None
+
+        rating = db.execute("SELECT rating FROM posts WHERE id = ?", (id,)).fetchone()[0]
+
+    return added, rating
+
+
+def count_votes(db: sqlite3.Connection, id: int) -> tuple[int, int]:
+    row = db.execute(
+        "SELECT COALESCE(SUM(value = 1), 0), COALESCE(SUM(value = -1), 0) FROM feedbacks WHERE post = ?",
+        (id,),
+    ).fetchone()
+
+    return row[0], row[1]
+
+
+def check_interval(db: sqlite3.Connection, uhash: str, exempt: bool = False) -> bool:
+    ## Applies the posting interval, returns False if the user has to wait before posting
+
+    with transaction(db=db):
+        row = db.execute("SELECT until FROM timings WHERE uhash = ?", (uhash,)).fetchone()
+
+        if row is not None and not exempt:
+            if row[0] > time.time():
+                return False
+
+            _ = db.execute("DELETE FROM timings WHERE uhash = ?", (uhash,))
+        else:
+            _ = db.execute(
+                "INSERT OR REPLACE INTO timings (uhash, until) VALUES (?, ?)",
+                (uhash, time.time() + config['policies']['postInterval']),
+            )
+
+    return True
+
+
+def queue_autodelete(db: sqlite3.Connection, id: int) -> None:
+    _ = db.execute("INSERT OR IGNORE INTO autodelete (post) VALUES (?)", (id,))
+
+
+def unqueue_autodelete(db: sqlite3.Connection, id: int) -> None:
+    _ = db.execute("DELETE FROM autodelete WHERE post = ?", (id,))
+
+
+def pending_autodelete(db: sqlite3.Connection, extra: int = 0) -> list[int]:
+    ## Returns the oldest posts beyond the auto-delete limit once `extra` more posts are queued
+
+    count = db.execute("SELECT COUNT(*) FROM autodelete").fetchone()[0]
+    overflow = count + extra - config['policies']['autoDeleteCount']
+
+    if overflow <= 0:
+        return []
+
+    return [
+        row[0]
+        for row in db.execute("SELECT post FROM autodelete ORDER BY seq LIMIT ?", (overflow,))
+    ]
+
+
+def fail_autodelete(db: sqlite3.Connection, id: int) -> bool:
+    ## Counts a failed deletion, returns True if the post was dropped from the queue after too many
+
+    with transaction(db=db):
+        _ = db.execute("UPDATE autodelete SET attempts = attempts + 1 WHERE post = ?", (id,))
+        cursor = db.execute(
+            "DELETE FROM autodelete WHERE post = ? AND attempts >= ?",
+            (id, config['deployment']['jobAttempts']),
+        )
+
+    return cursor.rowcount == 1
+
+
+def set_reply(db: sqlite3.Connection, uhash: str, id: int, expires: float | None = None) -> bool:
+    ## Returns False if the post does not exist
+
+    if expires is None:
+        expires = time.time() + config['policies']['replyModeTimeout']
+
+    cursor = db.execute(
+        "INSERT OR REPLACE INTO replies (uhash, post, expires) SELECT ?, id, ? FROM posts WHERE id = ?",
+        (uhash, expires, id),
+    )
+
+    return cursor.rowcount == 1
+
+
+def get_reply(db: sqlite3.Connection, uhash: str) -> int | None:
+    ## Returns the post the user is replying to, dropping the session if it is stale
+
+    row = db.execute("SELECT post, expires FROM replies WHERE uhash = ?", (uhash,)).fetchone()
+
+    if row is None:
+        return None
+
+    if row[1] <= time.time():
+        _ = db.execute("DELETE FROM replies WHERE uhash = ?", (uhash,))
+        return None
+
+    return row[0]
+
+
+def pop_reply(db: sqlite3.Connection, uhash: str) -> int | None:
+    with transaction(db=db):
+        id = get_reply(db=db, uhash=uhash)
+        _ = db.execute("DELETE FROM replies WHERE uhash = ?", (uhash,))
+
+    return id
+
+
+def expire_replies(db: sqlite3.Connection) -> None:
+    now = time.time()
+
+    if db.execute("SELECT 1 FROM replies WHERE expires <= ? LIMIT 1", (now,)).fetchone() is None:
+        return
+
+    _ = db.execute("DELETE FROM replies WHERE expires <= ?", (now,))
+
+
+def schedule_purge(db: sqlite3.Connection, chat: int, message: int, delay: float) -> None:
+    _ = db.execute(
+        "INSERT INTO purges (chat, message, due) VALUES (?, ?, ?)",
+        (chat, message, time.time() + delay),
+    )
+
+
+def due_purges(db: sqlite3.Connection) -> list[PurgeType]:
+    return [
+        {"id": row[0], "chat": row[1], "message": row[2]}
+        for row in db.execute("SELECT id, chat, message FROM purges WHERE due <= ?", (time.time(),))
+    ]
+
+
+def remove_purge(db: sqlite3.Connection, id: int) -> None:
+    _ = db.execute("DELETE FROM purges WHERE id = ?", (id,))
+
+
+def claim(db: sqlite3.Connection, key: str) -> bool:
+    ## Returns False if another worker already claimed the update
+
+    cursor = db.execute("INSERT OR IGNORE INTO claims (key, at) VALUES (?, ?)", (key, time.time()))
+
+    return cursor.rowcount == 1
+
+
+def prune_claims(db: sqlite3.Connection, age: float) -> None:
+    ## Telegram does not redeliver updates this old, so their claims can go
+
+    before = time.time() - age
+
+    if db.execute("SELECT 1 FROM claims WHERE at < ? LIMIT 1", (before,)).fetchone() is None:
+        return
+
+    _ = db.execute("DELETE FROM claims WHERE at < ?", (before,))
+
+
+def fail_purge(db: sqlite3.Connection, id: int) -> bool:
+    ## Counts a failed purge, returns True if it was dropped after too many
+
+    with transaction(db=db):
+        _ = db.execute("UPDATE purges SET attempts = attempts + 1 WHERE id = ?", (id,))
+        cursor = db.execute(
+            "DELETE FROM purges WHERE id = ? AND attempts >= ?",
+            (id, config['deployment']['jobAttempts']),
+        )
+
+    return cursor.rowcount == 1
+
+
+def queue_edit(db: sqlite3.Connection, id: int) -> None:
+    _ = db.execute(
+        "INSERT INTO edits (post) SELECT id FROM posts WHERE id = ? "
+        "ON CONFLICT (post) DO UPDATE SET version = version + 1",
+        (id,),
+    )
+
+
+def pending_edits(db: sqlite3.Connection) -> list[tuple[int, int]]:
+    return [(row[0], row[1]) for row in db.execute("SELECT post, version FROM edits")]
+
+
+def remove_edit(db: sqlite3.Connection, id: int, version: int) -> None:
+    ## Only removes the edit if no newer one was queued in the meantime
+
+    _ = db.execute("DELETE FROM edits WHERE post = ? AND version = ?", (id, version))
+
+
+def search(db: sqlite3.Connection, query: str, limit: int = 10) -> list[int]:
+    ## Ranks posts by the tf-idf score of the query tokens, newest first on ties
+
+    total = db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+    scores: dict[int, float] = {}
+
+    for token in set(tokenize(text=query)):
+        postings = db.execute("SELECT post, count FROM terms WHERE token = ?", (token,)).fetchall()
+
+        if not postings:
+            continue
+
+        idf = math.log(1 + total / len(postings))
+
+        for id, count in postings:
+            scores[id] = scores.get(id, 0.0) + count * idf
+
+    return sorted(scores, key=lambda id: (-scores[id], -id))[:limit]
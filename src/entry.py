@@ -6,8 +6,12 @@ import os
 import re
 import random
 import toml
+import typing
+import functools
+import concurrent.futures
 
 from hydrogram import filters
+from hydrogram.errors import BadRequest, FloodWait, Forbidden, MessageNotModified
 from hydrogram.methods.utilities.idle import idle
 from hydrogram.types import (
     InlineKeyboardButton,
@@ -20,15 +24,20 @@ config = toml.load("./config.toml")
 
 # Initialize Client and Setup Memory
 
+## Every worker needs its own session files, TGCHAN_WORKER names them
+
+worker = os.environ.get("TGCHAN_WORKER", "")
+session = config["general"]["name"] + (f"-{worker}" if worker else "")
+
 app = hydrogram.Client(
-    name=config["general"]["name"],
+    name=session,
     api_id=config["telegram"]["id"],
     api_hash=config["telegram"]["hash"],
     bot_token=config["telegram"]["token"],
 )
 
 p_app = hydrogram.Client(
-    name="p_" + config["general"]["name"],
+    name="p_" + session,
     api_id=config["telegram"]["id"],
     api_hash=config["telegram"]["hash"],
 )
@@ -39,7 +48,7 @@ run = loop.run_until_complete
 _ = run(app.start())
 _ = run(p_app.start())
 
-reply_mode: dict[str, int] = {}
+db = database.connect()
 
 
 # Define Core functions
@@ -65,16 +74,199 @@ def printlog(text: str) -> None:
         _ = f.write(f"[{time.strftime("%Y-%m-%d %H:%M:%S")}] {text}\n")
 
 
+## SQLite calls wait while another worker holds the write lock, so they run on a thread of their own
+## instead of blocking the event loop, one at a time since they share a connection
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+async def query(func: typing.Callable, /, **kwargs) -> typing.Any:
+    return await loop.run_in_executor(executor, functools.partial(func, db=db, **kwargs))
+
+
+def post_markup(
+    media: str | None, shash: str, likes: int = 0, dislikes: int = 0
+) -> InlineKeyboardMarkup:
+    ## Builds the keyboard of a post, with a link to the attached media if there is one
+
+    inline_keyboard = [
+        [
+            InlineKeyboardButton(
+                text=f"👍 : {likes}",
+                callback_data="like",
+            ),
+            InlineKeyboardButton(
+                text=f"👎 : {dislikes}",
+                callback_data="dislike",
+            ),
+            InlineKeyboardButton(
+                text="Reply",
+                callback_data="reply",
+            ),
+        ],
+    ]
+
+    if media is not None and media.endswith(".jpg"):
+        inline_keyboard.insert(
+            0,
+            [
+                InlineKeyboardButton(
+                    text="View attached photo",
+                    url=f"https://t.me/{config["telegram"]["username"]}?start={shash}-jpg",
+                ),
+            ],
+        )
+
+    elif media is not None and media.endswith(".mp4"):
+        inline_keyboard.insert(
+            0,
+            [
+                InlineKeyboardButton(
+                    text="View attached video",
+                    url=f"https://t.me/{config["telegram"]["username"]}?start={shash}-mp4",
+                ),
+            ],
+        )
+
+    return InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+
+
+async def claim(_, __, update: Message | CallbackQuery) -> bool:
+    ## Lets exactly one worker handle an update, however Telegram delivers it to the workers
+
+    if isinstance(update, CallbackQuery):
+        key = f"callback:{update.id}"
+    else:
+        key = f"message:{update.chat.id}:{update.id}"
+
+    return await query(database.claim, key=key)
+
+
+## Keep this filter last so an update is only claimed by the handler that matches it
+
+claimed = filters.create(func=claim)
+
+
+async def redraw(id: int) -> bool:
+    ## Renders the counters of a post from the database
+    ## Returns False if the edit failed or the votes changed while it was sent
+
+    post = await query(database.get_post, id=id)
+
+    if post is None:
+        return True
+
+    likes, dislikes = await query(database.count_votes, id=id)
+
+    try:
+        _ = await app.edit_message_reply_markup(
+            chat_id=config["database"]["post"],
+            message_id=id,
+            reply_markup=post_markup(
+                media=post["media"], shash=post["shash"], likes=likes, dislikes=dislikes
+            ),
+        )
+    except MessageNotModified:
+        pass
+    except (BadRequest, Forbidden):
+        ## The message can no longer be edited, retrying would not help
+        return True
+    except Exception:
+        return False
+
+    return await query(database.count_votes, id=id) == (likes, dislikes)
+
+
+# Define Background Jobs
+
+
+async def jobs() -> None:
+    ## Runs the jobs shared by all workers, only called on the elected worker
+    ## Queued work is only removed once the Telegram call for it succeeded or can never succeed,
+    ## other failures are retried up to deployment.jobAttempts times
+
+    _ = await query(database.expire_replies)
+    _ = await query(database.prune_claims, age=config["deployment"]["claimRetention"])
+
+    for id in await query(database.pending_autodelete):
+        try:
+            _ = await p_app.delete_messages(
+                chat_id=config["database"]["post"],
+                message_ids=id,
+            )
+        except FloodWait as e:
+            printlog(text=f"Auto-deletion is rate limited, retrying later: {e}")
+            break
+        except BadRequest as e:
+            ## The message no longer exists, only the post is left to remove
+            printlog(text=f"Message with id {id} is already gone: {e}")
+        except Forbidden as e:
+            printlog(text=f"Not allowed to auto-delete message with id {id}, dropping it: {e}")
+            _ = await query(database.unqueue_autodelete, id=id)
+            continue
+        except Exception as e:
+            dropped = await query(database.fail_autodelete, id=id)
+            printlog(text=f"Failed to auto-delete message with id {id}{", dropping it" if dropped else ""}: {e}")
+            continue
+
+        _ = await query(database.remove_post, id=id)
+
+        printlog(text=f"Auto-deleting message with id {id}!")
+
+    for purge in await query(database.due_purges):
+        try:
+            _ = await app.delete_messages(
+                chat_id=purge["chat"], message_ids=purge["message"]
+            )
+        except FloodWait as e:
+            printlog(text=f"Purging is rate limited, retrying later: {e}")
+            break
+        except (BadRequest, Forbidden) as e:
+            ## The message is gone or the user blocked the bot
+            printlog(text=f"Cannot purge message with id {purge["message"]}, dropping it: {e}")
+        except Exception as e:
+            dropped = await query(database.fail_purge, id=purge["id"])
+            printlog(text=f"Failed to purge message with id {purge["message"]}{", dropping it" if dropped else ""}: {e}")
+            continue
+
+        _ = await query(database.remove_purge, id=purge["id"])
+
+    for id, version in await query(database.pending_edits):
+        if await redraw(id=id):
+            _ = await query(database.remove_edit, id=id, version=version)
+
+
+async def background() -> None:
+    ## Keeps trying to become the leader and runs the background jobs once elected
+
+    leader = None
+
+    while True:
+        if leader is None:
+            leader = database.acquire_leader()
+
+            if leader is not None:
+                printlog(text=f"{session} is now running the background jobs!")
+
+        if leader is not None:
+            try:
+                await jobs()
+            except Exception as e:
+                printlog(text=f"Background jobs failed: {e}")
+
+        _ = await asyncio.sleep(config["deployment"]["jobInterval"])
+
+
 # Define Callback Functions
 
 
-@app.on_message(filters=filters.command(commands=["start"]))
+@app.on_message(filters=filters.command(commands=["start"]) & claimed)
 async def start(_, message: Message) -> None:
     if len(message.command) == 1:
         ## Intro Function
 
         _ = await message.reply_text(
-            text="Hello there! I am TG-Chan Posting Bot. I can help you post anonymous messages to TG-Chan.\n\nTo get started, just send me a message to post on TG-Chan, to reply to an existing post, you can just click on the reply button on that post and send me a reply message\n\nYou can view the privacy policy using the /privacy command."
+            text="Hello there! I am TG-Chan Posting Bot. I can help you post anonymous messages to TG-Chan.\n\nTo get started, just send me a message to post on TG-Chan, to reply to an existing post, you can just click on the reply button on that post and send me a reply message\n\nTo find an older post, use the /search command followed by a few keywords.\n\nYou can view the privacy policy using the /privacy command."
         )
 
     elif len(message.command) == 2:
@@ -101,7 +293,7 @@ async def start(_, message: Message) -> None:
             msg = _ = await message.reply_photo(
                 photo=file_path,
                 caption=(
-                    f"Here is the photo you requested. It will be deleted in {config["media"]["autoPurge"]} seconds."
+                    f"Here is the photo you requested. It will be deleted in {config["media"]["autoPurgeInterval"]} seconds."
                     if config["media"]["autoPurge"]
                     else "Here is the photo you requested."
                 ),
@@ -118,18 +310,20 @@ async def start(_, message: Message) -> None:
             )
 
         if config["media"]["autoPurge"]:
-            _ = await asyncio.sleep(config["media"]["autoPurgeInterval"])
-            try:
-                _ = await msg.delete()
-            except Exception:
-                return
+            _ = await query(
+                database.schedule_purge,
+                chat=msg.chat.id,
+                message=msg.id,
+                delay=config["media"]["autoPurgeInterval"],
+            )
     else:
         _ = await message.reply_text(text=("Invalid syntax!"))
 
 
 @app.on_message(
     filters=filters.private
-    & ~filters.command(commands=["start", "delete", "privacy", "cancel"])
+    & ~filters.command(commands=["start", "delete", "privacy", "cancel", "search"])
+    & claimed
 )
 async def post(client: hydrogram.Client, message: Message) -> None:
     ## Post Function
@@ -137,13 +331,10 @@ async def post(client: hydrogram.Client, message: Message) -> None:
     uhash = database.hash(num=message.from_user.id)
     text = "When you're ready, just click on the button down below to post your reply to TG-Chan!"
 
-    if uhash in reply_mode:
-        msg = _ = await client.get_messages(
-            chat_id=config["database"]["post"],
-            message_ids=reply_mode[uhash],
-        )
+    reply_id = await query(database.get_reply, uhash=uhash)
 
-        text += f"\n\nCurrently replying to the following message: {msg.link}"
+    if reply_id is not None:
+        text += f"\n\nCurrently replying to the following message: https://t.me/{config["database"]["postUsername"]}/{reply_id}"
 
     _ = await message.reply_text(
         text=text,
@@ -161,10 +352,8 @@ async def post(client: hydrogram.Client, message: Message) -> None:
     )
 
 
-@app.on_message(filters=filters.command(commands=["delete"]))
+@app.on_message(filters=filters.command(commands=["delete"]) & claimed)
 async def delete(client: hydrogram.Client, message: Message) -> None:
-    db = database.load()
-
     if len(message.command) != 3:
         _ = await message.reply_text(text=("Invalid syntax!"))
         return
@@ -182,14 +371,19 @@ async def delete(client: hydrogram.Client, message: Message) -> None:
             message_ids=int(message.command[1]),
         )
 
-        shash = db["posts"][msg.id]["shash"]
+        post = await query(database.get_post, id=msg.id)
     except Exception:
+        post = None
+
+    if post is None:
         _ = await message.reply_text(
             text=("Invalid message id! Please try again with a valid message id.")
         )
 
         return
 
+    shash = post["shash"]
+
     if (
         shash != database.hash(num=message.from_user.id + int(message.command[2]) - config["database"]["seed"])
         and message.from_user.id != config["database"]["owner"]
@@ -207,16 +401,38 @@ async def delete(client: hydrogram.Client, message: Message) -> None:
         message_ids=msg.id,
     )
 
-    database.remove_post(db=db, id=msg.id)
+    _ = await query(database.remove_post, id=msg.id)
 
     _ = await message.reply_text(text=("The message has been successfully deleted!"))
 
     printlog(f"User {shash} deleted a message with id {msg.id}!")
 
-    database.save(db=db)
 
+@app.on_message(filters=filters.command(commands=["search"]) & claimed)
+async def search(_: hydrogram.Client, message: Message) -> None:
+    if len(message.command) < 2:
+        _ = await message.reply_text(text=("Invalid syntax!"))
+        return
 
-@app.on_message(filters=filters.command(commands=["privacy"]))
+    results = await query(database.search, query=" ".join(message.command[1:]))
+
+    if not results:
+        _ = await message.reply_text(text=("No posts matched your search!"))
+        return
+
+    _ = await message.reply_text(
+        text=(
+            "Here are the posts matching your search:\n\n"
+            + "\n".join(
+                f"{rank}. https://t.me/{config["database"]["postUsername"]}/{id}"
+                for rank, id in enumerate(results, start=1)
+            )
+        ),
+        disable_web_page_preview=True,
+    )
+
+
+@app.on_message(filters=filters.command(commands=["privacy"]) & claimed)
 async def privacy(_: hydrogram.Client, message: Message) -> None:
     _ = await message.reply_text(
         text=(
@@ -226,230 +442,102 @@ async def privacy(_: hydrogram.Client, message: Message) -> None:
             "3. Your messages are not used for any other purpose than posting on TG-Chan.\n"
             "4. Your messages are not used to track you or your activities on the bot.\n"
             "5. Your hashes are generated in real-time for authentication and stored only for feedbacks.\n"
+            "6. The text and captions of your posts are stored locally for the /search command and are deleted together with the post.\n"
         ),
     )
 
 
-@app.on_callback_query()
+@app.on_callback_query(filters=claimed)
 async def callback(client: hydrogram.Client, callback: CallbackQuery) -> None:
-    db = database.load()
     uhash = database.hash(num=callback.from_user.id)
 
-    if callback.data == "like":
-        if callback.message.id not in db["posts"]:
-            _ = await callback.answer(text="Invalid message!")
-            return
-
-        if uhash in db["posts"][callback.message.id]["feedbacks"]:
-            if (
-                db["posts"][callback.message.id]["feedbacks"][uhash]
-                == database.Feedback.LIKE
-            ):
-                dislike = 0
-                like = -1
-                db["posts"][callback.message.id]["rating"] -= 1
-            else:
-                db["posts"][callback.message.id]["rating"] += 2
-                dislike = -1
-                db["posts"][callback.message.id]["feedbacks"][uhash] = (
-                    database.Feedback.LIKE
-                )
-                like = 1
-        else:
-            db["posts"][callback.message.id]["rating"] += 1
-            dislike = 0
-            db["posts"][callback.message.id]["feedbacks"][uhash] = (
-                database.Feedback.LIKE
-            )
-            like = 1
-
-        existing_reply_markup = callback.message.reply_markup.inline_keyboard
-
-        for row in existing_reply_markup:
-            for button in row:
-                if button.text.startswith("👍"):
-                    current = int(button.text.split(" : ")[1])
-                    button.text = (
-                        f"👍 : {current + like}" if current + like >= 0 else "👍 : 0"
-                    )
-                elif button.text.startswith("👎"):
-                    current = int(button.text.split(" : ")[1])
-                    button.text = (
-                        f"👎 : {current + dislike}"
-                        if current + dislike >= 0
-                        else "👎 : 0"
-                    )
-
-        try:
-            _ = await callback.message.edit_reply_markup(
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=existing_reply_markup)
-            )
-        except Exception:
-            pass
-
-        if (
-            db["posts"][callback.message.id]["rating"]
-            >= config["policies"]["autoDeleteDislikeLimit"]
-        ):
-            if callback.message.id in db["autodelete"]:
-                del db["autodelete"][callback.message.id]
+    if callback.data in ["like", "dislike"]:
+        ## Feedback Function
 
-        if (
-            db["posts"][callback.message.id]["rating"]
-            >= config["policies"]["pinLikeLimit"]
-        ):
-            _ = await callback.message.pin()
+        feedback = (
+            database.Feedback.LIKE
+            if callback.data == "like"
+            else database.Feedback.DISLIKE
+        )
 
-        if like == 1:
-            _ = await callback.answer(text="Thanks for the feedback!")
-        else:
-            _ = await callback.answer(text="Feedback removed!")
-            del db["posts"][callback.message.id]["feedbacks"][uhash]
+        result = await query(
+            database.vote,
+            id=callback.message.id, uhash=uhash, feedback=feedback
+        )
 
-    elif callback.data == "dislike":
-        if callback.message.id not in db["posts"]:
+        if result is None:
             _ = await callback.answer(text="Invalid message!")
             return
 
-        if uhash in db["posts"][callback.message.id]["feedbacks"]:
-            if (
-                db["posts"][callback.message.id]["feedbacks"][uhash]
-                == database.Feedback.DISLIKE
-            ):
-                like = 0
-                dislike = -1
-                db["posts"][callback.message.id]["rating"] += 1
-            else:
-                db["posts"][callback.message.id]["rating"] -= 2
-                like = -1
-                dislike = 1
-                db["posts"][callback.message.id]["feedbacks"][uhash] = (
-                    database.Feedback.DISLIKE
-                )
-        else:
-            db["posts"][callback.message.id]["rating"] -= 1
-            like = 0
-            dislike = 1
-            db["posts"][callback.message.id]["feedbacks"][uhash] = (
-                database.Feedback.DISLIKE
-            )
+        added, rating = result
 
-        existing_reply_markup = callback.message.reply_markup.inline_keyboard
+        if feedback == database.Feedback.LIKE:
+            if not await redraw(id=callback.message.id):
+                _ = await query(database.queue_edit, id=callback.message.id)
 
-        for row in existing_reply_markup:
-            for button in row:
-                if button.text.startswith("👍"):
-                    current = int(button.text.split(" : ")[1])
-                    button.text = (
-                        f"👍 : {current + like}" if current + like >= 0 else "👍 : 0"
-                    )
-                elif button.text.startswith("👎"):
-                    current = int(button.text.split(" : ")[1])
-                    button.text = (
-                        f"👎 : {current + dislike}"
-                        if current + dislike >= 0
-                        else "👎 : 0"
-                    )
+            if rating >= config["policies"]["autoDeleteDislikeLimit"]:
+                _ = await query(database.unqueue_autodelete, id=callback.message.id)
 
-        try:
-            _ = await callback.message.edit_reply_markup(
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=existing_reply_markup)
-            )
-        except Exception:
-            pass
+            if rating >= config["policies"]["pinLikeLimit"]:
+                _ = await callback.message.pin()
 
-        if (
-            db["posts"][callback.message.id]["rating"]
-            <= -config["policies"]["unpinDislikeLimit"]
-        ):
-            _ = await callback.message.unpin()
+        else:
+            if rating > -config["policies"]["deleteDislikeLimit"]:
+                if not await redraw(id=callback.message.id):
+                    _ = await query(database.queue_edit, id=callback.message.id)
 
-        if (
-            db["posts"][callback.message.id]["rating"]
-            <= -config["policies"]["deleteDislikeLimit"]
-        ):
-            if callback.message.id in db["autodelete"]:
-                del db["autodelete"][callback.message.id]
+            if rating <= -config["policies"]["unpinDislikeLimit"]:
+                _ = await callback.message.unpin()
 
-            _ = await p_app.delete_messages(
-                chat_id=config["database"]["post"],
-                message_ids=callback.message.id,
-            )
-            database.remove_post(db=db, id=callback.message.id)
+            if rating <= -config["policies"]["deleteDislikeLimit"]:
+                _ = await p_app.delete_messages(
+                    chat_id=config["database"]["post"],
+                    message_ids=callback.message.id,
+                )
+                _ = await query(database.remove_post, id=callback.message.id)
 
-        if dislike == 1:
+        if added:
             _ = await callback.answer(text="Thanks for the feedback!")
         else:
             _ = await callback.answer(text="Feedback removed!")
-            del db["posts"][callback.message.id]["feedbacks"][uhash]
 
     elif callback.data == "reply":
-        if callback.message.id not in db["posts"]:
+        if not await query(database.set_reply, uhash=uhash, id=callback.message.id):
             _ = await callback.answer(text="Invalid message!")
             return
 
-        reply_mode[uhash] = callback.message.id
-
         _ = await callback.answer(
             text="Reply mode activated! Please send your reply message via bot. You can exit reply mode by sending /cancel."
         )
 
-        return
-
     elif callback.data == "post":
         ## Post Function
 
-        uhash = database.hash(num=callback.from_user.id)
-
-        if (
-            uhash in db["timings"]
-            and callback.from_user.id != config["database"]["owner"]
+        if not await query(
+            database.check_interval,
+            uhash=uhash,
+            exempt=callback.from_user.id == config["database"]["owner"],
         ):
-            if db["timings"][uhash] > time.time():
-                _ = await callback.answer(
-                    text=("Please wait for a while before posting another message!")
-                )
-
-                return
-            else:
-                del db["timings"][uhash]
-        else:
-            db["timings"][uhash] = time.time() + config["policies"]["postInterval"]
-
-        seed = random.randint(a=-999_999, b=999_999)
-        shash = database.hash(num=callback.from_user.id + seed)
-
-        reply_id = reply_mode.pop(uhash) if uhash in reply_mode else None
-        try:
-            if reply_id is not None:
-                _ = await client.get_messages(
-                    chat_id=config["database"]["post"],
-                    message_ids=reply_id,
-                )
-        except Exception as e:
-            print(f"Error: {e}")
             _ = await callback.answer(
-                text=("Invalid reply id! Please try again with a valid reply id.")
+                text=("Please wait for a while before posting another message!")
             )
+
             return
 
-        if len(db["autodelete"]) >= config["policies"]["autoDeleteCount"]:
-            if reply_id == db["autodelete"][0]:
-                _ = await callback.answer(
-                    "Reply message is in the auto-delete queue! Please try again with a different message."
-                )
-                del db["reply_mode"][uhash]
+        seed = random.randint(a=-999_999, b=999_999)
+        shash = database.hash(num=callback.from_user.id + seed)
 
-            msg_id = db["autodelete"].pop(0)
-            database.remove_post(db=db, id=msg_id)
+        reply_id = await query(database.pop_reply, uhash=uhash)
 
-            printlog(text=f"Auto-deleting message with id {db['autodelete'][0]}!")
+        ## The leader deletes every post that falls past the limit once this one is queued
 
-            _ = await p_app.delete_messages(
-                chat_id=config["database"]["post"],
-                message_ids=msg_id,
+        if reply_id is not None and reply_id in await query(database.pending_autodelete, extra=1):
+            _ = await callback.answer(
+                "Reply message is in the auto-delete queue! Please try again with a different message."
             )
 
+            return
+
         message = callback.message.reply_to_message
 
         if message.photo:
@@ -460,7 +548,6 @@ async def callback(client: hydrogram.Client, callback: CallbackQuery) -> None:
                     )
                 )
 
-                database.save(db=db)
                 return
 
             _ = await message.download(file_name=f"media/{shash}.jpg")
@@ -473,43 +560,25 @@ async def callback(client: hydrogram.Client, callback: CallbackQuery) -> None:
                     if message.caption
                     else f"\n\nHash: {shash}"
                 ),
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text="View attached photo",
-                                url=f"https://t.me/{config["telegram"]["username"]}?start={shash}-jpg",
-                            ),
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                text="👍 : 0",
-                                callback_data="like",
-                            ),
-                            InlineKeyboardButton(
-                                text="👎 : 0",
-                                callback_data="dislike",
-                            ),
-                            InlineKeyboardButton(
-                                text="Reply",
-                                callback_data="reply",
-                            ),
-                        ],
-                    ],
-                ),
+                reply_markup=post_markup(media=f"media/{shash}.jpg", shash=shash),
             )
 
-            database.add_post(db=db, id=msg.id, media=f"media/{shash}.jpg", shash=shash)
+            _ = await query(
+                database.add_post,
+                id=msg.id,
+                media=f"media/{shash}.jpg",
+                shash=shash,
+                text=str(message.caption or ""),
+            )
 
         elif message.video:
-            if message.video.file_size > config["telegram"]["maxVideoSize"]:
+            if message.video.file_size > config["media"]["maxVideoSize"]:
                 _ = await message.reply_text(
                     text=(
                         "The video size is too large! Please try again with a smaller/compressed video or add a link to the video instead."
                     )
                 )
 
-                database.save(db=db)
                 return
 
             _ = await message.download(file_name=f"media/{shash}.mp4")
@@ -522,60 +591,26 @@ async def callback(client: hydrogram.Client, callback: CallbackQuery) -> None:
                     if message.caption
                     else f"\n\nHash: {shash}"
                 ),
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text="View attached video",
-                                url=f"https://t.me/{config["telegram"]["username"]}?start={shash}-mp4",
-                            ),
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                text="👍 : 0",
-                                callback_data="like",
-                            ),
-                            InlineKeyboardButton(
-                                text="👎 : 0",
-                                callback_data="dislike",
-                            ),
-                            InlineKeyboardButton(
-                                text="Reply",
-                                callback_data="reply",
-                            ),
-                        ],
-                    ],
-                ),
+                reply_markup=post_markup(media=f"media/{shash}.mp4", shash=shash),
             )
 
-            database.add_post(db=db, id=msg.id, media=f"media/{shash}.mp4", shash=shash)
+            _ = await query(
+                database.add_post,
+                id=msg.id,
+                media=f"media/{shash}.mp4",
+                shash=shash,
+                text=str(message.caption or ""),
+            )
 
         elif message.text:
             msg = _ = await client.send_message(
                 reply_to_message_id=reply_id,
                 chat_id=config["database"]["post"],
                 text=message.text.markdown + f"\n\nHash: {shash}",
-                reply_markup=InlineKeyboardMarkup(
-                    inline_keyboard=[
-                        [
-                            InlineKeyboardButton(
-                                text="👍 : 0",
-                                callback_data="like",
-                            ),
-                            InlineKeyboardButton(
-                                text="👎 : 0",
-                                callback_data="dislike",
-                            ),
-                            InlineKeyboardButton(
-                                text="Reply",
-                                callback_data="reply",
-                            ),
-                        ],
-                    ],
-                ),
+                reply_markup=post_markup(media=None, shash=shash),
             )
 
-            database.add_post(db=db, id=msg.id, shash=shash)
+            _ = await query(database.add_post, id=msg.id, shash=shash, text=str(message.text))
 
         else:
             _ = await message.reply_text(
@@ -584,10 +619,9 @@ async def callback(client: hydrogram.Client, callback: CallbackQuery) -> None:
                 )
             )
 
-            database.save(db=db)
             return
 
-        db["autodelete"].append(msg.id)
+        _ = await query(database.queue_autodelete, id=msg.id)
 
         _ = await callback.message.edit_text(
             text=(
@@ -600,25 +634,21 @@ async def callback(client: hydrogram.Client, callback: CallbackQuery) -> None:
     else:
         _ = await callback.answer(text="Invalid action!")
 
-        database.save(db=db)
-        return
-
-    database.save(db=db)
 
-
-@app.on_message(filters=filters.command(commands=["cancel"]))
+@app.on_message(filters=filters.command(commands=["cancel"]) & claimed)
 async def cancel(_: hydrogram.Client, message: Message) -> None:
     uhash = database.hash(num=message.from_user.id)
 
-    if uhash in reply_mode:
-        del reply_mode[uhash]
+    if await query(database.pop_reply, uhash=uhash) is not None:
         _ = await message.reply_text(text="Reply mode deactivated!")
     else:
         _ = await message.reply_text(text="You are not in reply mode!")
 
 
 # Run the Bot
-print("Bot is running!")
+print(f"Bot is running as {session}!")
+
+_ = loop.create_task(background())
 
 run(idle())
 
@@ -0,0 +1,377 @@
+import concurrent.futures
+import multiprocessing
+import pickle
+import time
+
+import pytest
+
+from src.db import database
+
+context = multiprocessing.get_context("fork")
+
+
+@pytest.fixture
+def name(tmp_path) -> str:
+    return str(tmp_path / "database.db")
+
+
+@pytest.fixture
+def db(name):
+    db = database.connect(name=name)
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def clock(monkeypatch) -> list[float]:
+    now = [1000.0]
+    monkeypatch.setattr(database.time, "time", lambda: now[0])
+    return now
+
+
+def cast_votes(name: str, worker: int, count: int) -> None:
+    db = database.connect(name=name)
+
+    for n in range(count):
+        feedback = database.Feedback.LIKE if n % 2 else database.Feedback.DISLIKE
+        _ = database.vote(db=db, id=1, uhash=f"{worker}-{n}", feedback=feedback)
+
+        ## Every worker also toggles one shared user so the same row is contended
+        _ = database.vote(db=db, id=1, uhash="shared", feedback=database.Feedback.LIKE)
+
+    db.close()
+
+
+def hold_leader(name: str, elected, release) -> None:
+    lock = database.acquire_leader(name=name)
+    elected.put(lock is not None)
+    _ = release.wait(timeout=30)
+
+
+def test_concurrent_votes(name, db):
+    database.add_post(db=db, shash="s", id=1)
+
+    workers = [
+        context.Process(target=cast_votes, args=(name, worker, 50))
+        for worker in range(6)
+    ]
+
+    for process in workers:
+        process.start()
+
+    for process in workers:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    likes, dislikes = database.count_votes(db=db, id=1)
+
+    ## 300 votes are split evenly, the shared user toggled an even number of times
+    assert (likes, dislikes) == (150, 150)
+    assert database.get_post(db=db, id=1)["rating"] == 0
+
+
+def test_vote_toggles(db):
+    database.add_post(db=db, shash="s", id=1)
+
+    assert database.vote(db=db, id=1, uhash="u", feedback=database.Feedback.LIKE) == (True, 1)
+    assert database.vote(db=db, id=1, uhash="u", feedback=database.Feedback.DISLIKE) == (True, -1)
+    assert database.vote(db=db, id=1, uhash="u", feedback=database.Feedback.DISLIKE) == (False, 0)
+    assert database.vote(db=db, id=2, uhash="u", feedback=database.Feedback.LIKE) is None
+
+
+def test_leader_election_and_takeover(name):
+    elected = context.Queue()
+    release = context.Event()
+    leader = context.Process(target=hold_leader, args=(name, elected, release))
+    leader.start()
+
+    assert elected.get(timeout=30)
+    assert database.acquire_leader(name=name) is None
+
+    release.set()
+    leader.join(timeout=30)
+
+    lock = database.acquire_leader(name=name)
+    assert lock is not None
+    lock.close()
+
+
+def test_pending_autodelete(db, monkeypatch):
+    monkeypatch.setitem(database.config["policies"], "autoDeleteCount", 3)
+
+    for id in range(1, 6):
+        database.add_post(db=db, shash="s", id=id)
+        database.queue_autodelete(db=db, id=id)
+
+    assert database.pending_autodelete(db=db) == [1, 2]
+    assert database.pending_autodelete(db=db, extra=1) == [1, 2, 3]
+
+    ## Nothing leaves the queue until the post is actually removed
+    assert database.pending_autodelete(db=db) == [1, 2]
+
+    database.remove_post(db=db, id=1)
+    database.unqueue_autodelete(db=db, id=2)
+
+    assert database.pending_autodelete(db=db) == []
+
+
+def test_due_purges(db):
+    database.schedule_purge(db=db, chat=10, message=1, delay=0)
+    database.schedule_purge(db=db, chat=10, message=2, delay=3600)
+
+    purges = database.due_purges(db=db)
+    assert [purge["message"] for purge in purges] == [1]
+
+    ## A purge that is not removed stays due for the next run
+    assert database.due_purges(db=db) == purges
+
+    database.remove_purge(db=db, id=purges[0]["id"])
+    assert database.due_purges(db=db) == []
+
+
+def test_pending_edits(db):
+    database.add_post(db=db, shash="s", id=1)
+    database.queue_edit(db=db, id=1)
+    database.queue_edit(db=db, id=2)
+
+    assert database.pending_edits(db=db) == [(1, 1)]
+
+    ## An edit queued again while the first one was sent is kept
+    database.queue_edit(db=db, id=1)
+    database.remove_edit(db=db, id=1, version=1)
+    assert database.pending_edits(db=db) == [(1, 2)]
+
+    database.remove_edit(db=db, id=1, version=2)
+    assert database.pending_edits(db=db) == []
+
+
+def test_remove_post_cascades(db):
+    database.add_post(db=db, shash="s", id=1, text="hello world")
+    database.queue_autodelete(db=db, id=1)
+    database.queue_edit(db=db, id=1)
+    _ = database.vote(db=db, id=1, uhash="u", feedback=database.Feedback.LIKE)
+
+    assert database.set_reply(db=db, uhash="u", id=1)
+    assert database.search(db=db, query="hello") == [1]
+
+    database.remove_post(db=db, id=1)
+
+    assert database.get_reply(db=db, uhash="u") is None
+    assert database.search(db=db, query="hello") == []
+    assert database.pending_edits(db=db) == []
+    assert database.count_votes(db=db, id=1) == (0, 0)
+    assert not database.set_reply(db=db, uhash="u", id=1)
+
+
+def test_migrate_pickle(name):
+    legacy = {
+        "posts": {
+            1: {
+                "feedbacks": {"u": database.Feedback.LIKE},
+                "media": None,
+                "shash": "s",
+                "rating": 1,
+                "text": "hello",
+            },
+        },
+        "timings": {"u": time.time() + 3600},
+        "autodelete": [1, 2],
+        "replies": {"u": {"post": 1, "expires": time.time() + 3600}},
+    }
+
+    with open(file=name, mode="wb") as f:
+        pickle.dump(obj=legacy, file=f)
+
+    db = database.connect(name=name)
+
+    assert database.get_post(db=db, id=1)["rating"] == 1
+    assert database.count_votes(db=db, id=1) == (1, 0)
+    assert database.search(db=db, query="hello") == [1]
+    assert database.get_reply(db=db, uhash="u") == 1
+    assert not database.check_interval(db=db, uhash="u")
+
+    db.close()
+
+
+def test_search_ranks_by_tf_idf(db):
+    database.add_post(db=db, shash="s", id=1, text="cat dog")
+    database.add_post(db=db, shash="s", id=2, text="cat cat")
+    database.add_post(db=db, shash="s", id=3, text="dog bird")
+    database.add_post(db=db, shash="s", id=4, text="fish")
+
+    ## Repeated terms score higher, rarer terms weigh more than common ones
+    assert database.search(db=db, query="cat") == [2, 1]
+    assert database.search(db=db, query="bird cat") == [2, 3, 1]
+    assert database.search(db=db, query="Bird, CAT!") == [2, 3, 1]
+
+
+def test_search_newest_first_on_ties(db):
+    for id in range(1, 4):
+        database.add_post(db=db, shash="s", id=id, text="same words")
+
+    assert database.search(db=db, query="same") == [3, 2, 1]
+
+
+def test_search_limit(db):
+    for id in range(1, 16):
+        database.add_post(db=db, shash="s", id=id, text="word")
+
+    assert database.search(db=db, query="word") == list(range(15, 5, -1))
+    assert database.search(db=db, query="word", limit=3) == [15, 14, 13]
+
+
+def test_search_drops_removed_posts(db):
+    database.add_post(db=db, shash="s", id=1, text="hello world")
+    database.add_post(db=db, shash="s", id=2, text="hello there")
+
+    database.remove_post(db=db, id=1)
+
+    assert database.search(db=db, query="hello world") == [2]
+    assert database.search(db=db, query="nothing") == []
+
+
+def test_reply_expires_after_timeout(db, clock):
+    timeout = database.config["policies"]["replyModeTimeout"]
+    database.add_post(db=db, shash="s", id=1)
+    database.set_reply(db=db, uhash="u", id=1)
+
+    clock[0] = 1000 + timeout - 1
+    assert database.get_reply(db=db, uhash="u") == 1
+
+    clock[0] = 1000 + timeout
+    assert database.get_reply(db=db, uhash="u") is None
+
+    ## The expired session was deleted, not just hidden
+    clock[0] = 1000
+    assert database.get_reply(db=db, uhash="u") is None
+
+
+def test_expire_replies_only_removes_expired(db, clock):
+    timeout = database.config["policies"]["replyModeTimeout"]
+    database.add_post(db=db, shash="s", id=1)
+    database.set_reply(db=db, uhash="u", id=1)
+
+    clock[0] = 1300
+    database.set_reply(db=db, uhash="v", id=1)
+
+    clock[0] = 1000 + timeout
+    database.expire_replies(db=db)
+
+    clock[0] = 1000
+    assert database.get_reply(db=db, uhash="u") is None
+    assert database.get_reply(db=db, uhash="v") == 1
+
+
+def test_reply_refreshes_expiry(db, clock):
+    timeout = database.config["policies"]["replyModeTimeout"]
+    database.add_post(db=db, shash="s", id=1)
+    database.set_reply(db=db, uhash="u", id=1)
+
+    clock[0] = 1200
+    database.set_reply(db=db, uhash="u", id=1)
+
+    clock[0] = 1000 + timeout
+    assert database.get_reply(db=db, uhash="u") == 1
+
+    clock[0] = 1200 + timeout
+    assert database.get_reply(db=db, uhash="u") is None
+
+
+def test_reply_dropped_with_post(db, clock):
+    database.add_post(db=db, shash="s", id=1)
+    database.set_reply(db=db, uhash="u", id=1)
+
+    database.remove_post(db=db, id=1)
+
+    assert database.get_reply(db=db, uhash="u") is None
+    assert database.pop_reply(db=db, uhash="u") is None
+
+
+def test_claim_once_across_connections(name, db):
+    other = database.connect(name=name)
+
+    assert database.claim(db=db, key="message:1:1")
+    assert not database.claim(db=other, key="message:1:1")
+    assert database.claim(db=other, key="callback:1")
+
+    other.close()
+
+
+def test_prune_claims(db, clock):
+    assert database.claim(db=db, key="old")
+
+    clock[0] = 2000
+    assert database.claim(db=db, key="new")
+
+    database.prune_claims(db=db, age=500)
+
+    assert database.claim(db=db, key="old")
+    assert not database.claim(db=db, key="new")
+
+
+def test_failed_migration_keeps_pickle(name):
+    legacy = {
+        "posts": {1: {"feedbacks": {"u": "like"}, "media": None, "shash": "s", "rating": 1}},
+        "timings": {},
+        "autodelete": [],
+    }
+
+    with open(file=name, mode="wb") as f:
+        pickle.dump(obj=legacy, file=f)
+
+    ## Every start fails loudly instead of opening an empty database
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            _ = database.connect(name=name)
+
+    with open(file=name, mode="rb") as f:
+        assert pickle.load(file=f) == legacy
+
+    legacy["posts"][1]["feedbacks"]["u"] = database.Feedback.LIKE
+
+    with open(file=name, mode="wb") as f:
+        pickle.dump(obj=legacy, file=f)
+
+    db = database.connect(name=name)
+
+    assert database.count_votes(db=db, id=1) == (1, 0)
+
+    db.close()
+
+    with open(file=name + ".pickle", mode="rb") as f:
+        assert pickle.load(file=f) == legacy
+
+
+def test_failed_autodelete_dropped_after_attempts(db, monkeypatch):
+    monkeypatch.setitem(database.config["policies"], "autoDeleteCount", 0)
+    monkeypatch.setitem(database.config["deployment"], "jobAttempts", 3)
+    database.add_post(db=db, shash="s", id=1)
+    database.queue_autodelete(db=db, id=1)
+
+    assert not database.fail_autodelete(db=db, id=1)
+    assert not database.fail_autodelete(db=db, id=1)
+    assert database.pending_autodelete(db=db) == [1]
+
+    assert database.fail_autodelete(db=db, id=1)
+    assert database.pending_autodelete(db=db) == []
+
+    ## Only the queue entry is dropped, the post is still tracked
+    assert database.get_post(db=db, id=1) is not None
+
+
+def test_failed_purge_dropped_after_attempts(db, monkeypatch):
+    monkeypatch.setitem(database.config["deployment"], "jobAttempts", 2)
+    database.schedule_purge(db=db, chat=10, message=1, delay=0)
+    id = database.due_purges(db=db)[0]["id"]
+
+    assert not database.fail_purge(db=db, id=id)
+    assert len(database.due_purges(db=db)) == 1
+
+    assert database.fail_purge(db=db, id=id)
+    assert database.due_purges(db=db) == []
+
+
+def test_connection_used_from_database_thread(db):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        _ = executor.submit(database.add_post, db=db, shash="s", id=1, text="hello").result()
+        assert executor.submit(database.search, db=db, query="hello").result() == [1]